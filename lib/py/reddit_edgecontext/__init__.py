@@ -1,14 +1,20 @@
 from __future__ import annotations
 
+import asyncio
 import logging
-import re
+import string
+import sys
+import threading
+import time
 
+from collections import OrderedDict
 from typing import Any
 from typing import Dict
+from typing import FrozenSet
 from typing import List
 from typing import NamedTuple
 from typing import Optional
-from typing import Set
+from typing import Tuple
 
 import jwt
 
@@ -31,7 +37,56 @@ from reddit_edgecontext.thrift.ttypes import Session as TSession
 logger = logging.getLogger(__name__)
 
 
-COUNTRY_CODE_RE = re.compile(r"^[A-Z]{2}$")
+try:
+    from thrift.protocol import fastbinary  # noqa: F401
+except ImportError:
+    logger.warning(
+        "The thrift C extension (thrift.protocol.fastbinary) is not available. "
+        "Edge-Request headers will be (de)serialized in pure Python, which is "
+        "much slower. Reinstall thrift with a compiler available to fix this."
+    )
+
+
+_COUNTRY_CODE_CHARS = frozenset(string.ascii_uppercase)
+
+
+def _is_country_code(value: str) -> bool:
+    return len(value) == 2 and value[0] in _COUNTRY_CODE_CHARS and value[1] in _COUNTRY_CODE_CHARS
+
+
+_SERVICE_SUBJECT_PREFIX = "service/"
+_SERVICE_SUBJECT_PREFIX_LEN = len(_SERVICE_SUBJECT_PREFIX)
+
+_CLAIM_SET_CACHE_SIZE = 1024
+_claim_set_cache: Dict[Tuple[str, ...], FrozenSet[str]] = {}
+
+
+def _claim_set(values: Optional[List[str]]) -> FrozenSet[str]:
+    # the same handful of role and scope combinations show up on nearly every
+    # token, so share one frozenset of interned strings per combination
+    key = tuple(values or ())
+    try:
+        claim_set = _claim_set_cache.get(key)
+    except TypeError:
+        # unhashable claim values can't be shared, build the set as-is
+        return frozenset(key)
+    if claim_set is None:
+        if len(_claim_set_cache) >= _CLAIM_SET_CACHE_SIZE:
+            _claim_set_cache.clear()
+        claim_set = frozenset(
+            sys.intern(value) if isinstance(value, str) else value for value in key
+        )
+        _claim_set_cache[key] = claim_set
+    return claim_set
+
+
+def _claim_set_or_none(values: Optional[List[str]]) -> Optional[FrozenSet[str]]:
+    # claims are read when a token is validated, so a malformed roles or scopes
+    # claim mustn't fail validation of an otherwise usable token
+    try:
+        return _claim_set(values)
+    except TypeError:
+        return None
 
 
 class NoAuthenticationError(Exception):
@@ -39,7 +94,18 @@ class NoAuthenticationError(Exception):
 
 
 class AuthenticationTokenValidator:
-    """Factory that knows how to validate raw authentication tokens."""
+    """Factory that knows how to validate raw authentication tokens.
+
+    Successfully validated tokens are kept in a bounded LRU cache keyed by the
+    raw token so that repeated requests with the same token skip signature
+    verification. Entries live no longer than the token's ``exp`` claim (and
+    never longer than ``_TOKEN_CACHE_MAX_TTL`` seconds) and the whole cache is
+    dropped when the public keys change. Invalid tokens are never cached.
+
+    """
+
+    _TOKEN_CACHE_SIZE = 4096
+    _TOKEN_CACHE_MAX_TTL = 300.0
 
     def __init__(self, secrets: SecretsStore):
         self.secrets = secrets
@@ -47,7 +113,10 @@ class AuthenticationTokenValidator:
         self._algorithm_name = "RS256"
         self._algorithm = get_default_algorithms()[self._algorithm_name]
         self._cache_mtime = 0.0
+        self._prepared_keys: Dict[bytes, Any] = {}
         self._public_keys: List[Any] = []
+        self._token_cache: OrderedDict[str, Tuple[float, AuthenticationToken]] = OrderedDict()
+        self._token_cache_lock = threading.Lock()
 
     def validate(self, token: str) -> AuthenticationToken:
         """Validate a raw authentication token and return an object.
@@ -56,24 +125,105 @@ class AuthenticationTokenValidator:
             either directly or from an upstream service
 
         """
-        if not token:
-            return InvalidAuthenticationToken()
+        authn_token = self._lookup(token)
+        if authn_token is not None:
+            return authn_token
+        return self._verify_token(token)
+
+    async def validate_async(self, token: str) -> AuthenticationToken:
+        """Validate a raw authentication token without blocking the event loop.
+
+        This behaves like :py:meth:`validate`, but on a cache miss the
+        signature verification runs in the event loop's default executor.
+
+        :param token: token value originating from the Authentication service
+            either directly or from an upstream service
+
+        """
+        authn_token = self._lookup(token)
+        if authn_token is not None:
+            return authn_token
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._verify_token, token)
 
+    def _refresh_public_keys(self) -> None:
         secret, mtime = self.secrets.get_versioned_and_mtime("secret/authentication/public-key")
-        if mtime > self._cache_mtime:
-            self._public_keys = [self._algorithm.prepare_key(key) for key in secret.all_versions]
-            self._cache_mtime = mtime
+        if mtime <= self._cache_mtime:
+            return
+
+        # only parse key versions we haven't seen before, secrets files are
+        # rewritten far more often than the public keys actually rotate
+        prepared_keys = {}
+        for key in secret.all_versions:
+            prepared_key = self._prepared_keys.get(key)
+            if prepared_key is None:
+                prepared_key = self._algorithm.prepare_key(key)
+            prepared_keys[key] = prepared_key
+
+        public_keys = list(prepared_keys.values())
+        if public_keys != self._public_keys:
+            with self._token_cache_lock:
+                self._public_keys = public_keys
+                self._token_cache.clear()
+        self._prepared_keys = prepared_keys
+        self._cache_mtime = mtime
+
+    def _lookup(self, token: str) -> Optional[AuthenticationToken]:
+        # resolve the token without verifying its signature if possible,
+        # returns None if it has to be verified
+        if not token:
+            return _INVALID_AUTHENTICATION_TOKEN
+
+        self._refresh_public_keys()
+        with self._token_cache_lock:
+            cached = self._token_cache.get(token)
+            if cached is None:
+                return None
+
+            expires_at, authn_token = cached
+            if expires_at <= time.time():
+                del self._token_cache[token]
+                return None
+
+            self._token_cache.move_to_end(token)
+            return authn_token
 
-        for public_key in self._public_keys:
+    def _verify_token(self, token: str) -> AuthenticationToken:
+        # parse the header once so that malformed tokens and tokens signed
+        # with another algorithm are rejected without trying every key
+        try:
+            header = jwt.get_unverified_header(token)
+        except jwt.InvalidTokenError:
+            return _INVALID_AUTHENTICATION_TOKEN
+        if header.get("alg") != self._algorithm_name:
+            return _INVALID_AUTHENTICATION_TOKEN
+
+        public_keys = self._public_keys
+        for public_key in public_keys:
             try:
                 decoded = jwt.decode(token, public_key, algorithms=[self._algorithm_name])
-                return ValidatedAuthenticationToken(decoded)
             except jwt.ExpiredSignatureError:
-                return InvalidAuthenticationToken()
+                return _INVALID_AUTHENTICATION_TOKEN
+            except jwt.InvalidSignatureError:
+                # signed with another version of the key, try the next one
+                continue
             except jwt.DecodeError:
-                pass
+                return _INVALID_AUTHENTICATION_TOKEN
+
+            authn_token = ValidatedAuthenticationToken(decoded)
+            expires_at = time.time() + self._TOKEN_CACHE_MAX_TTL
+            if "exp" in decoded:
+                expires_at = min(expires_at, decoded["exp"])
+            with self._token_cache_lock:
+                # the keys may have rotated while we were verifying, don't
+                # cache a token whose key could have just been removed
+                if self._public_keys is public_keys:
+                    self._token_cache[token] = (expires_at, authn_token)
+                    if len(self._token_cache) > self._TOKEN_CACHE_SIZE:
+                        self._token_cache.popitem(last=False)
+            return authn_token
 
-        return InvalidAuthenticationToken()
+        return _INVALID_AUTHENTICATION_TOKEN
 
 
 class AuthenticationToken:
@@ -85,13 +235,15 @@ class AuthenticationToken:
 
     """
 
+    __slots__ = ()
+
     @property
     def subject(self) -> Optional[str]:
         """Return the raw `subject` that is authenticated."""
         raise NotImplementedError
 
-    @cached_property
-    def user_roles(self) -> Set[str]:
+    @property
+    def user_roles(self) -> FrozenSet[str]:
         raise NotImplementedError
 
     @property
@@ -103,7 +255,7 @@ class AuthenticationToken:
         raise NotImplementedError
 
     @property
-    def scopes(self) -> Set[str]:
+    def scopes(self) -> FrozenSet[str]:
         raise NotImplementedError
 
     @property
@@ -116,45 +268,85 @@ class AuthenticationToken:
 
 
 class ValidatedAuthenticationToken(AuthenticationToken):
+    __slots__ = (
+        "payload",
+        "_subject",
+        "_user_roles",
+        "_oauth_client_id",
+        "_oauth_client_type",
+        "_scopes",
+        "_loid",
+        "_loid_created_ms",
+    )
+
     def __init__(self, payload: Dict[str, Any]):
         self.payload = payload
 
+        # tokens are shared between requests through the validator's cache so
+        # pull everything out of the payload once up front. roles, scopes and
+        # client types come from a small set of values so intern them to
+        # share one copy across tokens and speed up comparisons.
+        loid = payload.get("loid")
+        if not isinstance(loid, dict):
+            # a malformed loid claim shouldn't make the whole token unusable
+            loid = {}
+        oauth_client_type = payload.get("client_type")
+        self._subject: Optional[str] = payload.get("sub")
+        self._user_roles = _claim_set_or_none(payload.get("roles"))
+        self._oauth_client_id: Optional[str] = payload.get("client_id")
+        self._oauth_client_type: Optional[str] = (
+            sys.intern(oauth_client_type)
+            if isinstance(oauth_client_type, str)
+            else oauth_client_type
+        )
+        self._scopes = _claim_set_or_none(payload.get("scopes"))
+        self._loid: Optional[str] = loid.get("id")
+        self._loid_created_ms: Optional[int] = loid.get("created_ms")
+
     @property
     def subject(self) -> Optional[str]:
-        return self.payload.get("sub")
+        return self._subject
 
-    @cached_property
-    def user_roles(self) -> Set[str]:
-        return set(self.payload.get("roles", []))
+    @property
+    def user_roles(self) -> FrozenSet[str]:
+        if self._user_roles is None:
+            # malformed claim, raise the TypeError to whoever reads it
+            return _claim_set(self.payload.get("roles"))
+        return self._user_roles
 
     @property
     def oauth_client_id(self) -> Optional[str]:
-        return self.payload.get("client_id")
+        return self._oauth_client_id
 
     @property
     def oauth_client_type(self) -> Optional[str]:
-        return self.payload.get("client_type")
+        return self._oauth_client_type
 
     @property
-    def scopes(self) -> Set[str]:
-        return set(self.payload.get("scopes") or [])
+    def scopes(self) -> FrozenSet[str]:
+        if self._scopes is None:
+            # malformed claim, raise the TypeError to whoever reads it
+            return _claim_set(self.payload.get("scopes"))
+        return self._scopes
 
     @property
     def loid(self) -> Optional[str]:
-        return (self.payload.get("loid") or {}).get("id")
+        return self._loid
 
     @property
     def loid_created_ms(self) -> Optional[int]:
-        return (self.payload.get("loid") or {}).get("created_ms")
+        return self._loid_created_ms
 
 
 class InvalidAuthenticationToken(AuthenticationToken):
+    __slots__ = ()
+
     @property
     def subject(self) -> Optional[str]:
         raise NoAuthenticationError
 
-    @cached_property
-    def user_roles(self) -> Set[str]:
+    @property
+    def user_roles(self) -> FrozenSet[str]:
         raise NoAuthenticationError
 
     @property
@@ -166,7 +358,7 @@ class InvalidAuthenticationToken(AuthenticationToken):
         raise NoAuthenticationError
 
     @property
-    def scopes(self) -> Set[str]:
+    def scopes(self) -> FrozenSet[str]:
         raise NoAuthenticationError
 
     @property
@@ -178,6 +370,10 @@ class InvalidAuthenticationToken(AuthenticationToken):
         raise NoAuthenticationError
 
 
+# invalid tokens carry no state, so every failed validation shares this one
+_INVALID_AUTHENTICATION_TOKEN = InvalidAuthenticationToken()
+
+
 class Session(NamedTuple):
     """Wrapper for the session values in the EdgeContext."""
 
@@ -227,21 +423,28 @@ class User(NamedTuple):
             account.
 
         """
-        subject = self.authentication_token.subject
-        if not (subject and subject.startswith("t2_")):
+        user_id = self._account_id()
+        if user_id is None:
             raise NoAuthenticationError
-        return subject
+        return user_id
 
     @property
     def is_logged_in(self) -> bool:
         """Return if the User has a valid, authenticated id."""
-        try:
-            return self.id is not None
-        except NoAuthenticationError:
-            return False
+        return self._account_id() is not None
+
+    def _account_id(self) -> Optional[str]:
+        # InvalidAuthenticationToken raises on every attribute, so check for it
+        # up front instead of paying for an exception on every logged out request
+        if isinstance(self.authentication_token, InvalidAuthenticationToken):
+            return None
+        subject = self.authentication_token.subject
+        if not (subject and subject.startswith("t2_")):
+            return None
+        return subject
 
     @property
-    def roles(self) -> Set[str]:
+    def roles(self) -> FrozenSet[str]:
         """Return the authenticated roles for the current User.
 
         :raises: :py:class:`NoAuthenticationError` if there was no
@@ -278,25 +481,19 @@ class User(NamedTuple):
         """The LoID associated with the request, if applicable."""
 
         # First, if it's logged in user, return logged in user id.
-        try:
-            user_id = self.id
-            if user_id is not None:
-                return user_id
-        except NoAuthenticationError:
-            pass
+        user_id = self._account_id()
+        if user_id is not None:
+            return user_id
 
         # Next, return the loid from thrift payload if it's non-empty
         if self.loid_:
             return self.loid_
 
         # Finally, return loid from authentication token
-        try:
+        if not isinstance(self.authentication_token, InvalidAuthenticationToken):
             loid = self.authentication_token.loid
             if loid:
                 return loid
-        except NoAuthenticationError:
-            # self.authentication_token could be an InvalidAuthenticationToken
-            pass
 
         return ""
 
@@ -342,17 +539,19 @@ class OAuthClient(NamedTuple):
             authentication token defined for the current context
 
         """
-        lower_types = (client_type.lower() for client_type in client_types)
-        if not self.authentication_token.oauth_client_type:
+        oauth_client_type = self.authentication_token.oauth_client_type
+        if not oauth_client_type:
             return False
-        return self.authentication_token.oauth_client_type in lower_types
+        for client_type in client_types:
+            if client_type.lower() == oauth_client_type:
+                return True
+        return False
 
     def event_fields(self) -> Dict[str, Any]:
         """Return fields to be added to events."""
-        try:
-            oauth_client_id = self.id
-        except NoAuthenticationError:
-            oauth_client_id = None
+        oauth_client_id = None
+        if not isinstance(self.authentication_token, InvalidAuthenticationToken):
+            oauth_client_id = self.authentication_token.oauth_client_id
 
         return {"oauth_client_id": oauth_client_id}
 
@@ -374,11 +573,10 @@ class Service(NamedTuple):
 
         """
         subject = self.authentication_token.subject
-        if not (subject and subject.startswith("service/")):
+        if not (subject and subject.startswith(_SERVICE_SUBJECT_PREFIX)):
             raise NoAuthenticationError
 
-        name = subject[len("service/") :]
-        return name
+        return subject[_SERVICE_SUBJECT_PREFIX_LEN:]
 
 
 class EdgeContext:
@@ -399,12 +597,19 @@ class EdgeContext:
 
     def event_fields(self) -> Dict[str, Any]:
         """Return fields to be added to events."""
-        fields = {"session_id": self.session.id}
-        if self.device.id:
-            fields["device_id"] = self.device.id
-        fields.update(self.user.event_fields())
-        fields.update(self.oauth_client.event_fields())
-        return fields
+        # the fields can't change over the life of the context, so they're
+        # only computed once but copied so callers are free to modify them
+        return dict(self._event_fields)
+
+    @cached_property
+    def _event_fields(self) -> Dict[str, Any]:
+        device_id = self.device.id
+        return {
+            "session_id": self.session.id,
+            **({"device_id": device_id} if device_id else {}),
+            **self.user.event_fields(),
+            **self.oauth_client.event_fields(),
+        }
 
     @cached_property
     def authentication_token(self) -> AuthenticationToken:
@@ -413,10 +618,11 @@ class EdgeContext:
     @cached_property
     def user(self) -> User:
         """:py:class:`~reddit_edgecontext.User` object for the current context."""
+        loid = self._t_request.loid
         return User(
             authentication_token=self.authentication_token,
-            loid_=self._t_request.loid.id,
-            cookie_created_ms=self._t_request.loid.created_ms,
+            loid_=loid.id,
+            cookie_created_ms=loid.created_ms,
         )
 
     @cached_property
@@ -452,16 +658,24 @@ class EdgeContext:
     @cached_property
     def _t_request(self) -> TRequest:
         _t_request = TRequest()
-        _t_request.loid = TLoid()
-        _t_request.session = TSession()
-        _t_request.device = TDevice()
-        _t_request.origin_service = TOriginService()
-        _t_request.geolocation = TGeolocation()
         if self._header:
             try:
                 TSerialization.deserialize(_t_request, self._header, self._HEADER_PROTOCOL_FACTORY)
             except Exception:
                 logger.debug("Invalid Edge-Request header. %s", self._header)
+
+        # deserialization replaces any struct present in the header, so only
+        # fill in empty defaults for the ones that weren't
+        if _t_request.loid is None:
+            _t_request.loid = TLoid()
+        if _t_request.session is None:
+            _t_request.session = TSession()
+        if _t_request.device is None:
+            _t_request.device = TDevice()
+        if _t_request.origin_service is None:
+            _t_request.origin_service = TOriginService()
+        if _t_request.geolocation is None:
+            _t_request.geolocation = TGeolocation()
         return _t_request
 
     def attach_context(self, context: RequestContext) -> None:
@@ -474,6 +688,19 @@ class EdgeContext:
         context.raw_edge_context = self._header
 
 
+# the header for a context with nothing set never changes, so serialize it once
+_EMPTY_HEADER = TSerialization.serialize(
+    TRequest(
+        loid=TLoid(),
+        session=TSession(),
+        device=TDevice(),
+        origin_service=TOriginService(),
+        geolocation=TGeolocation(),
+    ),
+    EdgeContext._HEADER_PROTOCOL_FACTORY,
+)
+
+
 class EdgeContextFactory(BaseEdgeContextFactory):
     """Factory for creating :py:class:`EdgeContext` objects.
 
@@ -539,18 +766,32 @@ class EdgeContextFactory(BaseEdgeContextFactory):
             request orginated from.
 
         """
+        if (
+            authentication_token is None
+            and loid_id is None
+            and loid_created_ms is None
+            and session_id is None
+            and device_id is None
+            and origin_service_name is None
+            and country_code is None
+        ):
+            return EdgeContext(self.authn_token_validator, _EMPTY_HEADER)
+
         if loid_id is not None and not loid_id.startswith("t2_"):
             raise ValueError(
                 "loid_id <%s> is not in a valid format, it should be in the "
                 "fullname format with the '0' padding removed: 't2_loid_id'" % loid_id
             )
 
-        if country_code is not None and not COUNTRY_CODE_RE.match(country_code):
+        if country_code is not None and not _is_country_code(country_code):
             raise ValueError(
                 "country_code <%s> is not in a valid format, it should be in "
                 "ISO 3166-1 alpha-2 format: 'US'" % country_code
             )
 
+        if country_code is not None:
+            country_code = sys.intern(country_code)
+
         t_request = TRequest(
             loid=TLoid(id=loid_id, created_ms=loid_created_ms),
             session=TSession(id=session_id),
@@ -1,10 +1,21 @@
+import asyncio
+import base64
 import unittest
 
+from unittest import mock
+
+import jwt
+
 from baseplate.testing.lib.secrets import FakeSecretsStore
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
 
+from reddit_edgecontext import AuthenticationTokenValidator
 from reddit_edgecontext import EdgeContextFactory
 from reddit_edgecontext import InvalidAuthenticationToken
 from reddit_edgecontext import NoAuthenticationError
+from reddit_edgecontext import OAuthClient
+from reddit_edgecontext import Service
 from reddit_edgecontext import ValidatedAuthenticationToken
 
 
@@ -58,6 +69,14 @@ SERIALIZED_EDGECONTEXT_WITH_EXPIRED_AUTH = b"\x0c\x00\x01\x0b\x00\x01\x00\x00\x0
 SERIALIZED_EDGECONTEXT_WITH_ANON_AUTH = b"\x0c\x00\x01\x0b\x00\x01\x00\x00\x00\x0bt2_deadbeef\n\x00\x02\x00\x00\x00\x00\x00\x01\x86\xa0\x00\x0c\x00\x02\x0b\x00\x01\x00\x00\x00\x08beefdead\x00\x0b\x00\x03\x00\x00\x01\xc0eyJhbGciOiJSUzI1NiIsInR5cCI6IkpXVCJ9.eyJyb2xlcyI6WyJhbm9ueW1vdXMiXSwic3ViIjpudWxsLCJleHAiOjI1MjQ2MDgwMDB9.gQDiVzOUh70mKKK-YBTnLHWBOEuQyRllEE1-EIMfy3x5K8PsH9FB6Oy9S5HbILjfGFNrIBeux9HyW6hBDikoZDhn5QWyPNitL1pzMNONGGrXzSfaDoDbFy4MLD03A7zjG3qWBn_wLjgzUXX6qVX6W_gWO7dMqrq0iFvEegue-xQ1HGiXfPgnTrXRRovUO3JHy1LcZsmOjltYj5VGUTWXodBM8ObKEealDxg8yskEPy0IuujNMmb9eIyuHB8Ozzpg-lr790lxP37s5HCf18vrZ-IhRmLcLCqm5WSFyq_Ld2ByblBKL9pPst1AZYZTXNRIqovTAqr6v0-xjUeJ1iho9A\x00"  # noqa: E501
 
 
+def make_secrets(public_key):
+    return {
+        "secrets": {
+            "secret/authentication/public-key": {"type": "versioned", "current": public_key},
+        },
+    }
+
+
 class AuthenticationTokenTests(unittest.TestCase):
     def test_validated_authentication_token(self):
         payload = {
@@ -96,6 +115,50 @@ class AuthenticationTokenTests(unittest.TestCase):
         self.assertEqual(token.loid, None)
         self.assertEqual(token.loid_created_ms, None)
 
+    def test_validated_authentication_token_non_string_claims(self):
+        token = ValidatedAuthenticationToken(
+            {"client_type": 1, "roles": [1, "role_a"], "scopes": [2]}
+        )
+        self.assertEqual(token.oauth_client_type, 1)
+        self.assertEqual(token.user_roles, {1, "role_a"})
+        self.assertEqual(token.scopes, {2})
+
+        # malformed role and scope claims only fail when they're read
+        for claim, value, attr in (
+            ("roles", 1, "user_roles"),
+            ("roles", [["a"]], "user_roles"),
+            ("scopes", True, "scopes"),
+        ):
+            token = ValidatedAuthenticationToken({"sub": "t2_user", claim: value})
+            self.assertEqual(token.subject, "t2_user")
+            with self.assertRaises(TypeError):
+                getattr(token, attr)
+
+    def test_validated_authentication_token_malformed_loid(self):
+        token = ValidatedAuthenticationToken({"sub": "t2_user", "loid": "t2_user"})
+        self.assertEqual(token.subject, "t2_user")
+        self.assertEqual(token.loid, None)
+        self.assertEqual(token.loid_created_ms, None)
+
+    def test_validated_authentication_token_shares_claim_sets(self):
+        token_a = ValidatedAuthenticationToken({"roles": ["role_a"], "scopes": ["scope_a"]})
+        token_b = ValidatedAuthenticationToken({"roles": ["role_a"], "scopes": ["scope_a"]})
+        self.assertIs(token_a.user_roles, token_b.user_roles)
+        self.assertIs(token_a.scopes, token_b.scopes)
+
+    def test_oauth_client_is_type(self):
+        client = OAuthClient(ValidatedAuthenticationToken({"client_type": "third_party"}))
+        self.assertTrue(client.is_type("first_party", "Third_Party"))
+        self.assertFalse(client.is_type("first_party"))
+        self.assertFalse(OAuthClient(ValidatedAuthenticationToken({})).is_type("third_party"))
+
+    def test_service_name(self):
+        service = Service(ValidatedAuthenticationToken({"sub": "service/foo"}))
+        self.assertEqual(service.name, "foo")
+
+        with self.assertRaises(NoAuthenticationError):
+            Service(ValidatedAuthenticationToken({"sub": "t2_user"})).name
+
     def test_invalidated_authentication_token(self):
         token = InvalidAuthenticationToken()
         for attr in dir(token):
@@ -113,18 +176,11 @@ class EdgeContextTests(unittest.TestCase):
     ORIGIN_NAME = "baseplate"
     COUNTRY_CODE = "OK"
 
-    def setUp(self):
-        self.store = FakeSecretsStore(
-            {
-                "secrets": {
-                    "secret/authentication/public-key": {
-                        "type": "versioned",
-                        "current": AUTH_TOKEN_PUBLIC_KEY,
-                    }
-                },
-            }
-        )
-        self.factory = EdgeContextFactory(self.store)
+    @classmethod
+    def setUpClass(cls):
+        # one factory for the whole suite, as services keep one per process
+        cls.store = FakeSecretsStore(make_secrets(AUTH_TOKEN_PUBLIC_KEY))
+        cls.factory = EdgeContextFactory(cls.store)
 
     def test_create(self):
         request_context = self.factory.new(
@@ -162,6 +218,8 @@ class EdgeContextTests(unittest.TestCase):
             request_context._header,
             b"\x0c\x00\x01\x00\x0c\x00\x02\x00\x0c\x00\x04\x00\x0c\x00\x05\x00\x0c\x00\x06\x00\x00",
         )
+        self.assertIs(request_context.session.id, None)
+        self.assertFalse(request_context.user.is_logged_in)
 
     def test_logged_out_user(self):
         request_context = self.factory.from_upstream(SERIALIZED_EDGECONTEXT_WITH_NO_AUTH)
@@ -259,3 +317,93 @@ class EdgeContextTests(unittest.TestCase):
         self.assertEqual(request_context.user.cookie_created_ms, self.LOID_CREATED_MS)
         self.assertEqual(request_context.session.id, self.SESSION_ID)
         self.assertTrue(request_context.user.has_role("anonymous"))
+
+    def test_validated_token_is_cached(self):
+        validator = AuthenticationTokenValidator(self.store)
+        token = validator.validate(AUTH_TOKEN_VALID)
+        self.assertIsInstance(token, ValidatedAuthenticationToken)
+        self.assertIs(validator.validate(AUTH_TOKEN_VALID), token)
+
+        # stale entries are verified again rather than served from the cache
+        validator._token_cache[AUTH_TOKEN_VALID] = (0.0, token)
+        self.assertIsNot(validator.validate(AUTH_TOKEN_VALID), token)
+
+    def test_public_keys_reused_on_refresh(self):
+        validator = AuthenticationTokenValidator(self.store)
+        token = validator.validate(AUTH_TOKEN_VALID)
+        public_keys = validator._public_keys
+
+        # force a reload as if the secrets file had been rewritten
+        validator._cache_mtime = 0.0
+        self.assertIs(validator.validate(AUTH_TOKEN_VALID), token)
+        self.assertEqual(len(validator._public_keys), 1)
+        self.assertIs(validator._public_keys[0], public_keys[0])
+
+    def test_event_fields_copy(self):
+        request_context = self.factory.from_upstream(SERIALIZED_EDGECONTEXT_WITH_NO_AUTH)
+
+        fields = request_context.event_fields()
+        self.assertEqual(
+            list(fields),
+            [
+                "session_id",
+                "device_id",
+                "user_id",
+                "logged_in",
+                "cookie_created_timestamp",
+                "oauth_client_id",
+            ],
+        )
+        fields["session_id"] = "modified"
+        self.assertEqual(request_context.event_fields()["session_id"], self.SESSION_ID)
+
+    def test_malformed_token(self):
+        validator = self.factory.authn_token_validator
+        hs256_token = jwt.encode({"sub": "t2_example"}, "secret", algorithm="HS256")
+        # non-string kid, rejected while parsing the header
+        bad_kid_header = base64.urlsafe_b64encode(b'{"alg":"RS256","kid":1}').rstrip(b"=")
+        bad_kid_token = b".".join([bad_kid_header] + AUTH_TOKEN_VALID.split(b".")[1:])
+        for token in (b"not.a.token", hs256_token, bad_kid_token):
+            self.assertIsInstance(validator.validate(token), InvalidAuthenticationToken)
+
+    def test_validate_async(self):
+        validator = self.factory.authn_token_validator
+        token = asyncio.run(validator.validate_async(AUTH_TOKEN_VALID))
+        self.assertIsInstance(token, ValidatedAuthenticationToken)
+        self.assertIs(asyncio.run(validator.validate_async(AUTH_TOKEN_VALID)), token)
+        self.assertIsInstance(
+            asyncio.run(validator.validate_async(None)), InvalidAuthenticationToken
+        )
+
+    def test_key_rotation_during_verification(self):
+        other_public_key = (
+            rsa.generate_private_key(public_exponent=65537, key_size=2048)
+            .public_key()
+            .public_bytes(
+                serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+            )
+            .decode()
+        )
+        decode = jwt.decode
+
+        for use_async in (False, True):
+            with self.subTest(use_async=use_async):
+                store = FakeSecretsStore(make_secrets(AUTH_TOKEN_PUBLIC_KEY))
+                validator = AuthenticationTokenValidator(store)
+
+                def decode_and_rotate(*args, **kwargs):
+                    # the key that signed the token is removed while it is being verified
+                    decoded = decode(*args, **kwargs)
+                    store._filewatcher.data = make_secrets(other_public_key)
+                    store._filewatcher.mtime += 1
+                    validator._refresh_public_keys()
+                    return decoded
+
+                with mock.patch("jwt.decode", side_effect=decode_and_rotate):
+                    if use_async:
+                        asyncio.run(validator.validate_async(AUTH_TOKEN_VALID))
+                    else:
+                        validator.validate(AUTH_TOKEN_VALID)
+                self.assertIsInstance(
+                    validator.validate(AUTH_TOKEN_VALID), InvalidAuthenticationToken
+                )